@@ -0,0 +1,19 @@
+"""Compiles the Numba kernels of gravity_sim ahead of time into the grav_kernels extension.
+
+Run it once with `python build_kernels.py` on a machine with Numba. The extension needs only NumPy,
+and gravity_sim uses its serial kernels where Numba is not installed."""
+
+from numba.pycc import CC
+
+import gravity_sim
+
+cc = CC('grav_kernels')
+cc.export('accel_kernel', 'Tuple((f4[:, ::1], f8))(f4[:, ::1], f4[::1], f4, f4, i8)')(
+    gravity_sim._accel_kernel.py_func)
+cc.export('moments_kernel', 'Tuple((f8, f8[::1], f8[::1]))(f4[:, ::1], f4[:, ::1], f4[::1])')(
+    gravity_sim._moments_kernel.py_func)
+cc.export('verlet_steps', 'f8(f4[:, ::1], f4[:, ::1], f4[:, ::1], f4[::1], f4, f4, i8, f4, i8)')(
+    gravity_sim._verlet_steps_serial.py_func)
+
+if __name__ == "__main__":
+    cc.compile()
@@ -1,15 +1,472 @@
+import math
+import warnings
 import numpy as np
 import pygame
 
+try:
+    from numba import cuda, float32, get_num_threads, njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        """Leaves the decorated function as plain Python when Numba is not installed."""
+        if args and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+if NUMBA_AVAILABLE:
+    grav_kernels = None  # The JIT kernels run on all threads, the ahead-of-time ones on a single one
+else:
+    try:
+        import grav_kernels  # Compiled ahead of time by build_kernels.py
+    except ModuleNotFoundError:
+        grav_kernels = None
+    except ImportError as error:
+        warnings.warn("grav_kernels could not be loaded, falling back to NumPy. "
+                      f"Rebuild it with build_kernels.py. ({error})")
+        grav_kernels = None
+
+EPS2 = 1e-6  # Squared softening length keeping the force finite at zero distance
+BLOCK = 8  # Number of particles whose forces are computed together in a SIMD register
+TILE = 32  # Number of particles per cache tile of the pair kernel, a multiple of BLOCK
+TPB = 128  # Number of threads per block of the CUDA kernels
+MAX_DEPTH = 32  # Depth of the Barnes-Hut tree below which coincident particles share a leaf
+SMALL_N = 8  # Largest number of particles for which the kernels are generated with unrolled pairs
+TEXT_REFRESH_MS = 100  # Interval between renderings of the state attributes on the screen
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, fastmath=True, error_model='numpy', cache=True)
+    def _accel_kernel(pos, mass, G, eps2, threads):
+        """Calculates the softened gravitational acceleration of each particle from all the others,
+        and the total potential energy in the same pass.
+
+        Each pair is visited once and its force is applied to both particles by Newton's third law.
+        The rows are taken in tiles of TILE particles held in small local arrays, and each tile
+        meets the following particles one column tile at a time, so both tiles stay in the L1 cache.
+        Inside, the rows go in blocks of BLOCK particles, so that the innermost loop has a fixed
+        length and is unrolled into packed SIMD instructions.
+        Each of the given number of threads accumulates into its own buffer,
+        taking every chunks-th row tile of the triangle."""
+        N = pos.shape[0]
+        tiles = (N + TILE - 1) // TILE
+        chunks = max(min(threads, tiles), 1)
+        partial = np.zeros((chunks, N, 2), dtype=pos.dtype)
+        potentials = np.zeros(chunks)
+        for c in prange(chunks):
+            acc = partial[c]
+            potential = 0.0
+            xi = np.zeros(TILE, dtype=pos.dtype)
+            yi = np.zeros(TILE, dtype=pos.dtype)
+            mi = np.zeros(TILE, dtype=pos.dtype)
+            axi = np.zeros(TILE, dtype=pos.dtype)
+            ayi = np.zeros(TILE, dtype=pos.dtype)
+            poti = np.zeros(TILE, dtype=pos.dtype)
+            for t in range(c, tiles, chunks):
+                i0 = t * TILE
+                i1 = min(i0 + TILE, N)
+                for i in range(i0, i1):
+                    for j in range(i + 1, i1):
+                        dx = pos[j, 0] - pos[i, 0]
+                        dy = pos[j, 1] - pos[i, 1]
+                        r2 = dx * dx + dy * dy + eps2
+                        inv_r = np.float32(1.0) / math.sqrt(r2)
+                        inv_r3 = inv_r * inv_r * inv_r
+                        acc[i, 0] += mass[j] * dx * inv_r3
+                        acc[i, 1] += mass[j] * dy * inv_r3
+                        acc[j, 0] -= mass[i] * dx * inv_r3
+                        acc[j, 1] -= mass[i] * dy * inv_r3
+                        potential += mass[i] * mass[j] * inv_r
+                if i1 == N:
+                    continue
+                for k in range(TILE):
+                    xi[k] = pos[i0 + k, 0]
+                    yi[k] = pos[i0 + k, 1]
+                    mi[k] = mass[i0 + k]
+                    axi[k] = 0.0
+                    ayi[k] = 0.0
+                    poti[k] = 0.0
+                for j0 in range(i1, N, TILE):
+                    j1 = min(j0 + TILE, N)
+                    for b in range(0, TILE, BLOCK):
+                        for j in range(j0, j1):
+                            xj = pos[j, 0]
+                            yj = pos[j, 1]
+                            mj = mass[j]
+                            fxj = np.float32(0.0)
+                            fyj = np.float32(0.0)
+                            for k in range(b, b + BLOCK):
+                                dx = xj - xi[k]
+                                dy = yj - yi[k]
+                                r2 = dx * dx + dy * dy + eps2
+                                inv_r = np.float32(1.0) / math.sqrt(r2)
+                                inv_r3 = inv_r * inv_r * inv_r
+                                fx = dx * inv_r3
+                                fy = dy * inv_r3
+                                axi[k] += mj * fx
+                                ayi[k] += mj * fy
+                                poti[k] += mj * inv_r
+                                fxj += mi[k] * fx
+                                fyj += mi[k] * fy
+                            acc[j, 0] -= fxj
+                            acc[j, 1] -= fyj
+                for k in range(TILE):
+                    acc[i0 + k, 0] += axi[k]
+                    acc[i0 + k, 1] += ayi[k]
+                    potential += mi[k] * poti[k]
+            potentials[c] = potential
+        out = np.empty_like(pos)
+        for i in prange(N):
+            ax = np.float32(0.0)
+            ay = np.float32(0.0)
+            for c in range(chunks):
+                ax += partial[c, i, 0]
+                ay += partial[c, i, 1]
+            out[i, 0] = G * ax
+            out[i, 1] = G * ay
+        return out, - G * potentials.sum()
+
+    @njit(fastmath=True, cache=True)
+    def _drift(pos, vel, acc, dt):
+        """Moves the particles in place to their positions at the end of a Verlet step."""
+        half = np.float32(0.5)
+        for i in range(pos.shape[0]):
+            pos[i, 0] += vel[i, 0] * dt + half * acc[i, 0] * dt * dt
+            pos[i, 1] += vel[i, 1] * dt + half * acc[i, 1] * dt * dt
+
+    @njit(fastmath=True, cache=True)
+    def _kick(vel, acc, new_acc, dt):
+        """Updates the velocities in place with the mean of the old and new accelerations,
+        and stores the new accelerations."""
+        half = np.float32(0.5)
+        for i in range(vel.shape[0]):
+            vel[i, 0] += half * (acc[i, 0] + new_acc[i, 0]) * dt
+            vel[i, 1] += half * (acc[i, 1] + new_acc[i, 1]) * dt
+            acc[i, 0] = new_acc[i, 0]
+            acc[i, 1] = new_acc[i, 1]
+
+    def make_verlet(accel):
+        """Returns a kernel advancing the particles in place by the given number of Verlet steps,
+        with the accelerations computed by the given kernel.
+
+        It takes the same arguments as _verlet_steps and returns the potential energy after the last step.
+        Numba does not cache kernels that close over other kernels, so it is compiled on every launch."""
+        @njit(fastmath=True)
+        def verlet(pos, vel, acc, mass, G, dt, nsteps, eps2, threads):
+            potential = 0.0
+            for step in range(nsteps):
+                _drift(pos, vel, acc, dt)
+                new_acc, potential = accel(pos, mass, G, eps2, threads)
+                _kick(vel, acc, new_acc, dt)
+            return potential
+        return verlet
+
+    @njit(fastmath=True, cache=True)
+    def _verlet_steps(pos, vel, acc, mass, G, dt, nsteps, eps2, threads):
+        """Advances the particles in place by the given number of Verlet steps.
+
+        Returns the potential energy after the last step.
+        This is make_verlet(_accel_kernel) written out, so that it is cached between launches."""
+        potential = 0.0
+        for step in range(nsteps):
+            _drift(pos, vel, acc, dt)
+            new_acc, potential = _accel_kernel(pos, mass, G, eps2, threads)
+            _kick(vel, acc, new_acc, dt)
+        return potential
+
+    # pycc cannot link parallel loops, so build_kernels.py exports this serial variant of the Verlet loop.
+    _accel_kernel_serial = njit(fastmath=True, error_model='numpy')(_accel_kernel.py_func)
+    _verlet_steps_serial = make_verlet(_accel_kernel_serial)
+
+    @njit(fastmath=True, cache=True)
+    def _moments_kernel(pos, vel, mass):
+        """Calculates the total kinetic energy, momentum and center of mass in one pass."""
+        kinetic = 0.0
+        momentum = np.zeros(2)
+        center_of_mass = np.zeros(2)
+        total_mass = 0.0
+        for i in range(pos.shape[0]):
+            kinetic += 0.5 * mass[i] * (vel[i, 0] * vel[i, 0] + vel[i, 1] * vel[i, 1])
+            momentum[0] += mass[i] * vel[i, 0]
+            momentum[1] += mass[i] * vel[i, 1]
+            center_of_mass[0] += mass[i] * pos[i, 0]
+            center_of_mass[1] += mass[i] * pos[i, 1]
+            total_mass += mass[i]
+        return kinetic, momentum, center_of_mass / total_mass
+
+    @cuda.jit(fastmath=True)
+    def _accel_cuda(pos, mass, G, eps2, out, pot):
+        """Calculates the softened gravitational acceleration and the potential per unit mass
+        of each particle on the GPU, one thread per particle.
+
+        The other particles are staged through shared memory in tiles of TPB particles."""
+        s_pos = cuda.shared.array((TPB, 2), float32)
+        s_mass = cuda.shared.array(TPB, float32)
+        N = pos.shape[0]
+        i = cuda.grid(1)
+        tx = cuda.threadIdx.x
+        xi = pos[i, 0] if i < N else float32(0.0)
+        yi = pos[i, 1] if i < N else float32(0.0)
+        ax = float32(0.0)
+        ay = float32(0.0)
+        pot_i = float32(0.0)
+        for tile in range(0, N, TPB):
+            j = tile + tx
+            if j < N:
+                s_pos[tx, 0] = pos[j, 0]
+                s_pos[tx, 1] = pos[j, 1]
+                s_mass[tx] = mass[j]
+            else:
+                s_pos[tx, 0] = float32(0.0)
+                s_pos[tx, 1] = float32(0.0)
+                s_mass[tx] = float32(0.0)
+            cuda.syncthreads()
+            for k in range(TPB):
+                dx = s_pos[k, 0] - xi
+                dy = s_pos[k, 1] - yi
+                r2 = dx * dx + dy * dy + eps2
+                inv_r = float32(1.0) / math.sqrt(r2)
+                inv = s_mass[k] * inv_r * inv_r * inv_r
+                ax += inv * dx
+                ay += inv * dy
+                if tile + k != i:
+                    pot_i += s_mass[k] * inv_r
+            cuda.syncthreads()
+        if i < N:
+            out[i, 0] = G * ax
+            out[i, 1] = G * ay
+            pot[i] = pot_i
+
+    @cuda.jit(fastmath=True)
+    def _drift_cuda(pos, vel, acc, dt):
+        """Updates the positions on the GPU in the first half of a Verlet step."""
+        i = cuda.grid(1)
+        if i < pos.shape[0]:
+            pos[i, 0] += vel[i, 0] * dt + float32(0.5) * acc[i, 0] * dt * dt
+            pos[i, 1] += vel[i, 1] * dt + float32(0.5) * acc[i, 1] * dt * dt
+
+    @cuda.jit(fastmath=True)
+    def _kick_cuda(vel, acc0, acc1, dt):
+        """Updates the velocities on the GPU in the second half of a Verlet step."""
+        i = cuda.grid(1)
+        if i < vel.shape[0]:
+            vel[i, 0] += float32(0.5) * (acc0[i, 0] + acc1[i, 0]) * dt
+            vel[i, 1] += float32(0.5) * (acc0[i, 1] + acc1[i, 1]) * dt
+
+@njit(fastmath=True, cache=True)
+def _tree_build(pos, mass, node_com, node_mass, node_center, node_width,
+                first_child, next_sibling, node_particle):
+    """Inserts the particles one by one into a quadtree stored in the given node arrays.
+
+    A leaf holds the index of its particle, -1 if it is empty, or -2 if it holds several
+    particles at MAX_DEPTH. Returns the number of nodes, or -1 if the arrays are too small."""
+    N = pos.shape[0]
+    capacity = node_mass.shape[0]
+    lower_x = upper_x = pos[0, 0]
+    lower_y = upper_y = pos[0, 1]
+    for p in range(1, N):
+        lower_x = min(lower_x, pos[p, 0])
+        upper_x = max(upper_x, pos[p, 0])
+        lower_y = min(lower_y, pos[p, 1])
+        upper_y = max(upper_y, pos[p, 1])
+    node_center[0, 0] = (lower_x + upper_x) / 2
+    node_center[0, 1] = (lower_y + upper_y) / 2
+    node_width[0] = max(upper_x - lower_x, upper_y - lower_y, 1e-6)
+    node_com[0, 0] = node_com[0, 1] = node_mass[0] = 0.0
+    first_child[0] = next_sibling[0] = node_particle[0] = -1
+    size = 1
+
+    for p in range(N):
+        node = 0
+        depth = 0
+        while True:
+            node_mass[node] += mass[p]
+            node_com[node, 0] += mass[p] * pos[p, 0]
+            node_com[node, 1] += mass[p] * pos[p, 1]
+            if first_child[node] < 0:
+                if node_particle[node] == -1:
+                    node_particle[node] = p
+                    break
+                if node_particle[node] == -2 or depth == MAX_DEPTH:
+                    node_particle[node] = -2
+                    break
+                if size + 4 > capacity:
+                    return -1
+                first_child[node] = size
+                for q in range(4):
+                    child = size + q
+                    node_center[child, 0] = node_center[node, 0] + ((q & 1) - 0.5) * node_width[node] / 2
+                    node_center[child, 1] = node_center[node, 1] + ((q >> 1) - 0.5) * node_width[node] / 2
+                    node_width[child] = node_width[node] / 2
+                    node_com[child, 0] = node_com[child, 1] = node_mass[child] = 0.0
+                    first_child[child] = node_particle[child] = -1
+                    next_sibling[child] = child + 1 if q < 3 else next_sibling[node]
+                size += 4
+                old = node_particle[node]
+                node_particle[node] = -1
+                child = first_child[node] + (pos[old, 0] >= node_center[node, 0]) \
+                    + 2 * (pos[old, 1] >= node_center[node, 1])
+                node_mass[child] = mass[old]
+                node_com[child, 0] = mass[old] * pos[old, 0]
+                node_com[child, 1] = mass[old] * pos[old, 1]
+                node_particle[child] = old
+            node = first_child[node] + (pos[p, 0] >= node_center[node, 0]) \
+                + 2 * (pos[p, 1] >= node_center[node, 1])
+            depth += 1
+
+    for node in range(size):
+        if node_mass[node] > 0:
+            node_com[node, 0] /= node_mass[node]
+            node_com[node, 1] /= node_mass[node]
+    return size
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _tree_walk(pos, mass, node_com, node_mass, node_center, node_width, first_child, next_sibling,
+               node_particle, G, theta, eps2):
+    """Calculates the accelerations and the total potential energy by walking the quadtree.
+
+    A node is opened when its width is at least theta times its distance from the particle.
+    Otherwise, or if it is a leaf, it acts as a single particle at its center of mass, and the walk
+    jumps to next_sibling, the node following its subtree, so no stack is needed.
+    The nodes containing the particle are always opened, and a leaf it shares with others
+    at MAX_DEPTH acts without the particle's own mass."""
+    N = pos.shape[0]
+    out = np.empty_like(pos)
+    potential = 0.0
+    for i in prange(N):
+        ax = np.float32(0.0)
+        ay = np.float32(0.0)
+        pot_i = np.float32(0.0)
+        node = 0
+        path = 0
+        while node >= 0:
+            if node_mass[node] == 0 or node_particle[node] == i:
+                node = next_sibling[node]
+                continue
+            m = node_mass[node]
+            com_x = node_com[node, 0]
+            com_y = node_com[node, 1]
+            if node == path:
+                if first_child[node] >= 0:
+                    path = first_child[node] + (pos[i, 0] >= node_center[node, 0]) \
+                        + 2 * (pos[i, 1] >= node_center[node, 1])
+                    node = first_child[node]
+                    continue
+                m -= mass[i]
+                if m <= 0:
+                    node = next_sibling[node]
+                    continue
+                com_x = (node_com[node, 0] * node_mass[node] - mass[i] * pos[i, 0]) / m
+                com_y = (node_com[node, 1] * node_mass[node] - mass[i] * pos[i, 1]) / m
+            dx = com_x - pos[i, 0]
+            dy = com_y - pos[i, 1]
+            r2 = dx * dx + dy * dy + eps2
+            if first_child[node] < 0 or node_width[node] * node_width[node] < theta * theta * r2:
+                inv_r = np.float32(1.0) / math.sqrt(r2)
+                inv = m * inv_r * inv_r * inv_r
+                ax += inv * dx
+                ay += inv * dy
+                pot_i += m * inv_r
+                node = next_sibling[node]
+            else:
+                node = first_child[node]
+        out[i, 0] = G * ax
+        out[i, 1] = G * ay
+        potential += - 0.5 * G * mass[i] * pot_i
+    return out, potential
+
+if NUMBA_AVAILABLE:
+    accel_kernel = _accel_kernel
+    moments_kernel = _moments_kernel
+    verlet_kernel = _verlet_steps
+    kernel_threads = get_num_threads()
+elif grav_kernels is not None:
+    accel_kernel = grav_kernels.accel_kernel
+    moments_kernel = grav_kernels.moments_kernel
+    verlet_kernel = grav_kernels.verlet_steps
+    kernel_threads = 1
+else:
+    accel_kernel = moments_kernel = verlet_kernel = None
+    kernel_threads = 1
+
+_small_kernels = {}
+
+def small_kernels(N):
+    """Returns an acceleration kernel and a Verlet kernel for exactly N particles, generated with
+    the loop over the pairs written out in full and compiled on first use.
+    Generated kernels are not cached, so they are compiled again on every launch.
+
+    They take the same arguments as _accel_kernel and _verlet_steps."""
+    if N not in _small_kernels:
+        lines = ["def accel(pos, mass, G, eps2, threads):"]
+        for i in range(N):
+            lines += [f"    x{i} = pos[{i}, 0]",
+                      f"    y{i} = pos[{i}, 1]",
+                      f"    m{i} = mass[{i}]",
+                      f"    ax{i} = np.float32(0.0)",
+                      f"    ay{i} = np.float32(0.0)"]
+        lines.append("    potential = 0.0")
+        for i in range(N):
+            for j in range(i + 1, N):
+                lines += [f"    dx = x{j} - x{i}",
+                          f"    dy = y{j} - y{i}",
+                          "    r2 = dx * dx + dy * dy + eps2",
+                          "    inv_r = np.float32(1.0) / math.sqrt(r2)",
+                          "    inv_r3 = inv_r * inv_r * inv_r",
+                          f"    ax{i} += m{j} * dx * inv_r3",
+                          f"    ay{i} += m{j} * dy * inv_r3",
+                          f"    ax{j} -= m{i} * dx * inv_r3",
+                          f"    ay{j} -= m{i} * dy * inv_r3",
+                          f"    potential += m{i} * m{j} * inv_r"]
+        lines.append("    out = np.empty_like(pos)")
+        for i in range(N):
+            lines += [f"    out[{i}, 0] = G * ax{i}",
+                      f"    out[{i}, 1] = G * ay{i}"]
+        lines.append("    return out, - G * potential")
+        namespace = {"np": np, "math": math}
+        exec("\n".join(lines), namespace)
+        accel = njit(fastmath=True)(namespace["accel"])
+        _small_kernels[N] = accel, make_verlet(accel)
+    return _small_kernels[N]
+
+def as_float32(array):
+    """Returns the array as a C-contiguous float32 array, the only layout the compiled kernels accept."""
+    return np.ascontiguousarray(array, dtype=np.float32)
+
 class Particle:
     """Represents a particle."""
 
     def __init__(self, mass, position_x, position_y, velocity_x, velocity_y):
         """Initializes a particle by its mass, position, and velocity."""
         self.mass = mass
-        self.position = np.array([float(position_x), float(position_y)])
-        self.velocity = np.array([float(velocity_x), float(velocity_y)])
-        self.acceleration = np.array([0.0, 0.0])
+        self.position_x = float(position_x)
+        self.position_y = float(position_y)
+        self.velocity_x = float(velocity_x)
+        self.velocity_y = float(velocity_y)
+        self._state = None
+        self._index = None
+
+    @property
+    def position(self):
+        """Returns the position of the particle, read from its state if it belongs to one."""
+        if self._state is None:
+            return np.array([self.position_x, self.position_y])
+        return self._state.positions[self._index]
+
+    @property
+    def velocity(self):
+        """Returns the velocity of the particle, read from its state if it belongs to one."""
+        if self._state is None:
+            return np.array([self.velocity_x, self.velocity_y])
+        return self._state.velocities[self._index]
+
+    @property
+    def acceleration(self):
+        """Returns the acceleration of the particle, read from its state if it belongs to one."""
+        if self._state is None:
+            return np.zeros(2)
+        return self._state.accelerations[self._index]
 
     def __str__(self):
         """Prints the attributes of a particle."""
@@ -23,28 +480,101 @@ class Particle:
 
     __repr__ = __str__
 
+class BarnesHutTree:
+    """Represents a Barnes-Hut quadtree of particles stored in flat arrays, one per node attribute.
+
+    The four children of a node are stored next to each other from first_child on, and next_sibling
+    points to the node following the subtree of a node."""
+
+    def __init__(self, capacity=64):
+        """Initializes an empty tree with room for the given number of nodes."""
+        self.size = 0
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        """Allocates the node arrays with room for the given number of nodes."""
+        self.node_com = np.zeros((capacity, 2), dtype=np.float32)
+        self.node_mass = np.zeros(capacity, dtype=np.float32)
+        self.node_center = np.zeros((capacity, 2), dtype=np.float32)
+        self.node_width = np.zeros(capacity, dtype=np.float32)
+        self.first_child = np.full(capacity, -1, dtype=np.int32)
+        self.next_sibling = np.full(capacity, -1, dtype=np.int32)
+        self.node_particle = np.full(capacity, -1, dtype=np.int32)
+
+    def build(self, positions, masses):
+        """Builds the tree from the positions and masses of the particles."""
+        while True:
+            self.size = _tree_build(positions, masses, self.node_com, self.node_mass, self.node_center,
+                                    self.node_width, self.first_child, self.next_sibling,
+                                    self.node_particle)
+            if self.size >= 0:
+                return
+            self.allocate(2 * len(self.node_mass))
+
+    def walk(self, positions, masses, NewtonG, theta):
+        """Walks the tree for every particle, returning the accelerations and the potential energy."""
+        return _tree_walk(positions, masses, self.node_com, self.node_mass, self.node_center, self.node_width,
+                          self.first_child, self.next_sibling, self.node_particle,
+                          np.float32(NewtonG), np.float32(theta), np.float32(EPS2))
+
 class State:
     """Represents a state consisting of multiple particles."""
 
-    def __init__(self, NewtonG, particles, dt):
-        """Initializes a state."""
+    def __init__(self, NewtonG, particles, dt, theta=0, device='cpu', unroll=False):
+        """Initializes a state.
+
+        A positive theta approximates the gravitational force with a Barnes-Hut tree,
+        while theta=0 sums over all pairs of particles exactly.
+        With device='cuda' the exact sum and the integration run on the GPU, and the particles
+        are copied back to the host only when the trackables are updated.
+        With unroll=True and at most SMALL_N particles, the kernels are generated for the exact number
+        of particles, which makes each step faster at the cost of a compilation on every launch."""
+        if device not in ('cpu', 'cuda'):
+            raise ValueError(f"Unknown device {device!r}, use 'cpu' or 'cuda'.")
+        if device == 'cuda' and not (NUMBA_AVAILABLE and cuda.is_available()):
+            raise ValueError("device='cuda' requires Numba and a CUDA capable GPU.")
+        if device == 'cuda' and theta > 0:
+            raise ValueError("device='cuda' computes the exact pairwise force, use theta=0.")
         self.NewtonG = NewtonG
         self.particles = particles
         self.dt = dt
+        self.theta = theta
+        self.device = device
+        self.tree = BarnesHutTree(4 * len(particles)) if theta > 0 else None
 
         self.number_of_particles = len(particles)
-        self.masses = np.array([particle.mass for particle in particles])
-        self.positions = np.vstack(
-            [particle.position for particle in particles])
-        self.velocities = np.vstack(
-            [particle.velocity for particle in particles])
-
-        self.accelerations = self.calculate_acceleration()
-        self.momentum = self.calculate_momentum()
-        self.kinetic_energy = self.calculate_kinetic()
-        self.potential_energy = self.calculate_potential()
-        self.energy = self.calculate_energy()
-        self.center_of_mass = self.calculate_center_of_mass()
+        self.masses = np.array([particle.mass for particle in particles], dtype=np.float32)
+        self.positions = np.empty((self.number_of_particles, 2), dtype=np.float32)
+        self.velocities = np.empty((self.number_of_particles, 2), dtype=np.float32)
+        for i, particle in enumerate(particles):
+            self.positions[i] = particle.position
+            self.velocities[i] = particle.velocity
+            particle._state = self
+            particle._index = i
+
+        self.accel_kernel = accel_kernel
+        self.verlet_kernel = verlet_kernel
+        if unroll and NUMBA_AVAILABLE and self.number_of_particles <= SMALL_N:
+            self.accel_kernel, self.verlet_kernel = small_kernels(self.number_of_particles)
+
+        if self.device == 'cuda':
+            self.cuda_blocks = (self.number_of_particles + TPB - 1) // TPB
+            self.d_positions = cuda.to_device(self.positions)
+            self.d_velocities = cuda.to_device(self.velocities)
+            self.d_masses = cuda.to_device(self.masses)
+            self.d_accelerations = cuda.device_array_like(self.positions)
+            self.d_new_accelerations = cuda.device_array_like(self.positions)
+            self.d_potentials = cuda.device_array(self.number_of_particles, dtype=np.float32)
+            _accel_cuda[self.cuda_blocks, TPB](self.d_positions, self.d_masses, np.float32(self.NewtonG),
+                                               np.float32(EPS2), self.d_accelerations, self.d_potentials)
+        else:
+            if theta == 0 and self.accel_kernel is None:
+                self._dist_buf = np.empty((self.number_of_particles, self.number_of_particles, 2),
+                                          dtype=np.float32)
+                self._r2_buf = np.empty((self.number_of_particles, self.number_of_particles),
+                                        dtype=np.float32)
+            self.accelerations, self.potential_energy = self.calculate_gravity()
+        self.update_trackables()
         self.angular_momentum = self.calculate_angular_momentum()
 
     def __str__(self):
@@ -59,30 +589,26 @@ class State:
 
     __repr__ = __str__
 
-    def calculate_acceleration(self):
-        """Calculates the acceleration of particles from Newton's gravitational force."""
-        dist = self.positions[np.newaxis, :, :] - self.positions[:, np.newaxis, :]
-        result = np.linalg.norm(dist, axis=-1)
-        result += np.eye(self.number_of_particles)
-        result = 1 / result ** 3
-        result -= np.eye(self.number_of_particles)
-        result[result == np.inf] = 0
-        result = result[:, :, np.newaxis] * dist
-        result = self.NewtonG * self.masses[:, np.newaxis] * result
-        result = np.sum(result, axis=1)
-        return result
-
-    def calculate_potential(self):
-        """Calculates the total potential energy in the state."""
-        result = self.positions[np.newaxis, :, :] - self.positions[:, np.newaxis, :]
-        result = np.linalg.norm(result, axis=-1)
-        result += np.eye(self.number_of_particles)
-        result = 1 / result
-        result -= np.eye(self.number_of_particles)
-        result[result == np.inf] = 0
-        result = - self.NewtonG * self.masses[:, np.newaxis] * self.masses[np.newaxis, :] * result
-        result = np.sum(result)
-        return result
+    def calculate_gravity(self):
+        """Calculates the acceleration of particles from Newton's gravitational force,
+        and the total potential energy in the state from the same pairwise distances."""
+        if self.theta > 0:
+            self.tree.build(self.positions, self.masses)
+            return self.tree.walk(self.positions, self.masses, self.NewtonG, self.theta)
+        if self.accel_kernel is not None:
+            return self.accel_kernel(as_float32(self.positions), as_float32(self.masses),
+                                     np.float32(self.NewtonG), np.float32(EPS2), kernel_threads)
+        dist = np.subtract(self.positions[np.newaxis, :, :], self.positions[:, np.newaxis, :],
+                           out=self._dist_buf)
+        result = np.einsum('ijk,ijk->ij', dist, dist, out=self._r2_buf)
+        result += EPS2
+        np.sqrt(result, out=result)
+        np.reciprocal(result, out=result)
+        np.fill_diagonal(result, 0)  # Drops the self-energy, the self-force already vanishes with dist
+        potential = - 0.5 * self.NewtonG * self.masses @ result @ self.masses
+        np.power(result, 3, out=result)
+        result *= self.masses
+        return np.float32(self.NewtonG) * np.einsum('ij,ijk->ik', result, dist), potential
 
     def calculate_kinetic(self):
         """Calculates the total kinetic energy in the state."""
@@ -102,53 +628,98 @@ class State:
 
     def calculate_angular_momentum(self):
         """Calculates the total angular momentum of the state w.r.t. its center of mass."""
-        result = self.masses[:, np.newaxis] * (self.velocities - self.momentum / np.sum(self.masses))
-        result = np.cross(self.positions - self.center_of_mass, result)
-        return - np.sum(result)
-
-    def update(self):
-        """Calculates the attributes of particles in each time step using Verlet integration."""
-        x0 = self.positions
-        v0 = self.velocities
-        a0 = self.accelerations
-        dt = self.dt
-        self.positions = x0 + v0 * dt + 0.5 * a0 * dt * dt
-        a1 = self.accelerations = self.calculate_acceleration()
-        self.velocities = v0 + 0.5 * (a0 + a1) * dt
+        v_rel = self.velocities - self.momentum / np.sum(self.masses)
+        r_rel_x = self.positions[:, 0] - self.center_of_mass[0]
+        r_rel_y = self.positions[:, 1] - self.center_of_mass[1]
+        return - np.sum(self.masses * (r_rel_x * v_rel[:, 1] - r_rel_y * v_rel[:, 0]))
+
+    def update(self, steps=1):
+        """Calculates the attributes of particles over the given number of time steps using Verlet integration."""
+        if self.device == 'cuda':
+            for step in range(steps):
+                self.update_cuda()
+            return
+        if steps <= 0:
+            return
+        if self.theta == 0 and self.verlet_kernel is not None:
+            self.positions = as_float32(self.positions)
+            self.velocities = as_float32(self.velocities)
+            self.accelerations = as_float32(self.accelerations)
+            self.potential_energy = self.verlet_kernel(self.positions, self.velocities, self.accelerations,
+                                                       self.masses, np.float32(self.NewtonG), np.float32(self.dt),
+                                                       steps, np.float32(EPS2), kernel_threads)
+            return
+        dt = np.float32(self.dt)
+        for step in range(steps):
+            a0 = self.accelerations
+            self.positions += self.velocities * dt + 0.5 * a0 * dt * dt
+            a1, self.potential_energy = self.calculate_gravity()
+            self.accelerations = a1
+            self.velocities += 0.5 * (a0 + a1) * dt
+
+    def update_cuda(self):
+        """Calculates a Verlet step on the GPU, keeping the particles in device memory."""
+        grid = self.cuda_blocks, TPB
+        dt = np.float32(self.dt)
+        _drift_cuda[grid](self.d_positions, self.d_velocities, self.d_accelerations, dt)
+        _accel_cuda[grid](self.d_positions, self.d_masses, np.float32(self.NewtonG), np.float32(EPS2),
+                          self.d_new_accelerations, self.d_potentials)
+        _kick_cuda[grid](self.d_velocities, self.d_accelerations, self.d_new_accelerations, dt)
+        self.d_accelerations, self.d_new_accelerations = self.d_new_accelerations, self.d_accelerations
 
     def update_trackables(self):
-        """Updates the remaining attributes of the particles and the state."""
-        for i, particle in enumerate(self.particles):
-            particle.position = self.positions[i]
-            particle.velocity = self.velocities[i]
-            particle.acceleration = self.accelerations[i]
-        self.momentum = self.calculate_momentum()
-        self.kinetic_energy = self.calculate_kinetic()
-        self.potential_energy = self.calculate_potential()
+        """Updates the remaining attributes of the state."""
+        if self.device == 'cuda':
+            self.positions = self.d_positions.copy_to_host()
+            self.velocities = self.d_velocities.copy_to_host()
+            self.accelerations = self.d_accelerations.copy_to_host()
+            self.potential_energy = - 0.5 * self.NewtonG * self.masses @ self.d_potentials.copy_to_host()
+        if moments_kernel is not None:
+            self.kinetic_energy, self.momentum, self.center_of_mass = moments_kernel(
+                as_float32(self.positions), as_float32(self.velocities), as_float32(self.masses))
+        else:
+            self.momentum = self.calculate_momentum()
+            self.kinetic_energy = self.calculate_kinetic()
+            self.center_of_mass = self.calculate_center_of_mass()
         self.energy = self.calculate_energy()
-        self.center_of_mass = self.calculate_center_of_mass()
 
 class Simulation:
     """Executes a pygame simulation for the gravitational dynamics of the particles."""
 
-    def __init__(self, particles, width=1000, height=500, refresh_rate=100, dt=0.005, NewtonG=1):
+    def __init__(self, particles, width=1000, height=500, refresh_rate=100, dt=0.005, NewtonG=1,
+                 theta=0, device='cpu', unroll=False):
         """Initializes the simulation."""
         pygame.init()
         self.screen = pygame.display.set_mode([width, height])
         self.font = pygame.font.SysFont(None, 15)
         self.refresh_rate = refresh_rate
         self.particles = particles
-        self.colors = [(np.random.randint(0, 255),
-                        np.random.randint(100, 255),
-                        np.random.randint(0, 245), 100)
-                       for i in range(len(particles))]
-        self.state = State(NewtonG, self.particles, dt)
+        n = len(particles)
+        self.colors = np.column_stack([np.random.randint(0, 255, n, dtype=np.uint8),
+                                       np.random.randint(100, 255, n, dtype=np.uint8),
+                                       np.random.randint(0, 245, n, dtype=np.uint8),
+                                       np.full(n, 100, dtype=np.uint8)])
+        self._color_tuples = [tuple(color) for color in self.colors.tolist()]
+        self.state = State(NewtonG, self.particles, dt, theta, device, unroll)
         self.running = True
         self.pause = False
         self.width = width
         self.height = height
+        self._screen_center = np.array([width / 2, height / 2])
+
+        self._sprites = []
+        self._sprite_offsets = np.empty((len(particles), 2))
+        radii = [math.sqrt(particle.mass) for particle in particles]
+        for i, radius in enumerate(radii):
+            center = math.ceil(radius)
+            sprite = pygame.Surface((2 * center + 1, 2 * center + 1), pygame.SRCALPHA)
+            pygame.draw.circle(sprite, self._color_tuples[i][:3], (center, center), radius)
+            self._sprites.append(sprite)
+            self._sprite_offsets[i] = center
         self.trajectory = False
         self.position_display = False
+        self._text_cache_time = 0
+        self._text_surfs = []
 
         self.run()
 
@@ -173,33 +744,35 @@ class Simulation:
                     self.position_display = not self.position_display
 
     def draw_text(self):
-        """Displays a text on the top-left corner with the state attributes."""
-        txt = self.font.render(
-            f"Energy: {np.round(self.state.energy, 3)}, Kinetic: {np.round(self.state.kinetic_energy, 3)}, Potential: {np.round(self.state.potential_energy, 3)}",
-            True, (255, 255, 255))
-        self.screen.blit(txt, (0, 0))
-        txt = self.font.render(
-            f"Momentum: [{np.round(self.state.momentum[0],3)}, {np.round(self.state.momentum[1],3)}],  (norm: {np.round(np.linalg.norm(self.state.momentum),3)})",
-            True, (255, 255, 255))
-        self.screen.blit(txt, (0, 10))
-        txt = self.font.render(
-            f"Ang. momentum: {np.round(self.state.angular_momentum, 3)}",
-            True, (255, 255, 255))
-        self.screen.blit(txt, (0, 20))
+        """Displays a text on the top-left corner with the state attributes.
+
+        The text is rendered again at most every TEXT_REFRESH_MS milliseconds."""
+        now = pygame.time.get_ticks()
+        if not self._text_surfs or now - self._text_cache_time >= TEXT_REFRESH_MS:
+            self._text_cache_time = now
+            state = self.state
+            lines = [
+                f"Energy: {state.energy:.3f}, Kinetic: {state.kinetic_energy:.3f}, Potential: {state.potential_energy:.3f}",
+                f"Momentum: [{state.momentum[0]:.3f}, {state.momentum[1]:.3f}],  (norm: {math.hypot(*state.momentum):.3f})",
+                f"Ang. momentum: {state.angular_momentum:.3f}"]
+            self._text_surfs = [(self.font.render(line, True, (255, 255, 255)), (0, 10 * i))
+                                for i, line in enumerate(lines)]
+        for surf, pos in self._text_surfs:
+            self.screen.blit(surf, pos)
 
     def draw_particle(self):
         """Draws the particles and displays their attributes."""
-        for i, particle in enumerate(self.particles):
-            if self.position_display:
+        screen_positions = (self.state.positions - self.state.center_of_mass
+                            + self._screen_center - self._sprite_offsets)
+        self.screen.blits(list(zip(self._sprites, screen_positions.tolist())), doreturn=False)
+        if self.position_display:
+            for i, particle in enumerate(self.particles):
+                x, y = particle.position.tolist()
+                vx, vy = particle.velocity.tolist()
                 txt = self.font.render(
-                    f"Particle {i+1}  | mass: {np.round(particle.mass)} pos: {np.round(particle.position, 2)} vel: {np.round(particle.velocity, 2)}",
-                    True, self.colors[i])
+                    f"Particle {i+1}  | mass: {particle.mass:.0f} pos: [{x:.2f} {y:.2f}] vel: [{vx:.2f} {vy:.2f}]",
+                    True, self._color_tuples[i])
                 self.screen.blit(txt, (0, 50 + 10 * i))
-            pygame.draw.circle(self.screen,
-                               self.colors[i],
-                               list(particle.position - self.state.center_of_mass
-                                    + np.array([self.width / 2, self.height / 2])),
-                               np.sqrt(particle.mass))
 
     def run(self):
         """Runs the simulation."""
@@ -217,6 +790,5 @@ class Simulation:
             pygame.display.flip()  # Updates what is shown on the screen
 
             if self.pause == False:
-                for i in range(self.refresh_rate):
-                    self.state.update()
+                self.state.update(self.refresh_rate)
                 self.state.update_trackables()